@@ -1,22 +1,39 @@
+import mmap
 import os
 import random
 import re
 import sys
-import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from scipy.sparse import csr_matrix
+except ImportError:
+    csr_matrix = None
 
 DAMPING = 0.85
 SAMPLES = 10000
+TOLERANCE = 1e-6
+MAX_ITERATIONS = 100
+
+HREF_RE = re.compile(rb"<a\s[^>]*?href=\"([^\"]*)\"", re.IGNORECASE)
 
 
 def main():
     if len(sys.argv) != 2:
         sys.exit("Usage: python pagerank.py corpus")
-    corpus = crawl(sys.argv[1])
-    ranks = sample_pagerank(corpus, DAMPING, SAMPLES)
+    graph = crawl_csr(sys.argv[1])
+    ranks = _sample_csr(*graph, DAMPING, SAMPLES)
     print(f"PageRank Results from Sampling (n = {SAMPLES})")
     for page in sorted(ranks):
         print(f"  {page}: {ranks[page]:.4f}")
-    ranks = iterate_pagerank(corpus, DAMPING)
+    ranks = _iterate_csr(*graph, DAMPING)
     print(f"PageRank Results from Iteration")
     for page in sorted(ranks):
         print(f"  {page}: {ranks[page]:.4f}")
@@ -28,25 +45,95 @@ def crawl(directory):
     Return a dictionary where each key is a page, and values are
     a list of all other pages in the corpus that are linked to by the page.
     """
-    pages = dict()
+    names, indptr, indices, _ = crawl_csr(directory)
+    return {
+        name: {names[j] for j in indices[indptr[i]:indptr[i + 1]]}
+        for i, name in enumerate(names)
+    }
+
+
+def crawl_csr(directory):
+    """
+    Parse a directory of HTML pages into a CSR link graph.
 
-    # Extract all links from HTML files
-    for filename in os.listdir(directory):
-        if not filename.endswith(".html"):
-            continue
-        with open(os.path.join(directory, filename)) as f:
-            contents = f.read()
-            links = re.findall(r"<a\s+(?:[^>]*?)href=\"([^\"]*)\"", contents)
-            pages[filename] = set(links) - {filename}
+    Return a tuple `(names, indptr, indices, out_deg)` where `names` is
+    the list of pages, the pages linked to by `names[i]` are
+    `indices[indptr[i]:indptr[i + 1]]`, and `out_deg[i]` is their number.
+    """
+    with os.scandir(directory) as entries:
+        files = [entry for entry in entries if entry.name.endswith(".html")]
+
+    # Extract all links from HTML files, overlapping their file I/O
+    workers = min(32, (os.cpu_count() or 1) * 2)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        links = executor.map(_parse_links, [entry.path for entry in files])
+        links_by_file = {
+            entry.name: file_links for entry, file_links in zip(files, links)
+        }
+
+    return _build_csr(list(links_by_file), links_by_file)
+
+
+def _parse_links(path):
+    """
+    Return the targets of all links in the HTML file at `path`.
+    """
+    with open(path, "rb") as f:
+        # An empty file cannot be memory-mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            # Every link starts with "<a", so skip files without one
+            if contents.find(b"<a") == -1 and contents.find(b"<A") == -1:
+                return []
+            # Links are matched on the raw bytes, so only the links get decoded
+            return [
+                link.decode("utf-8", "replace")
+                for link in HREF_RE.findall(contents)
+            ]
+
+
+def corpus_csr(corpus):
+    """
+    Return the link graph of the dictionary `corpus` in the CSR form
+    returned by `crawl_csr`.
+    """
+    return _build_csr(list(corpus), corpus)
+
+
+def _build_csr(names, links_by_name):
+    """
+    Resolve the link names of every page in `names` to page numbers and
+    pack them into CSR arrays.
+    """
+    N = len(names)
+    name_to_id = {name: i for i, name in enumerate(names)}
 
     # Only include links to other pages in the corpus
-    for filename in pages:
-        pages[filename] = set(
-            link for link in pages[filename]
-            if link in pages
-        )
+    indices_buf = []
+    row_len = np.empty(N, dtype=np.int32)
+    for i, name in enumerate(names):
+        start = len(indices_buf)
+        for link in links_by_name[name]:
+            j = name_to_id.get(link)
+            if j is not None and j != i:
+                indices_buf.append(j)
+        row_len[i] = len(indices_buf) - start
+
+    # Sort the links of each page and drop repeated ones
+    rows = np.repeat(np.arange(N, dtype=np.int32), row_len)
+    cols = np.array(indices_buf, dtype=np.int32)
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    keep = np.ones(len(cols), dtype=bool)
+    keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, indices = rows[keep], cols[keep]
 
-    return pages
+    out_deg = np.bincount(rows, minlength=N).astype(np.int32)
+    indptr = np.zeros(N + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(out_deg)
+
+    return names, indptr, indices, out_deg
 
 
 def transition_model(corpus, page, damping_factor):
@@ -64,8 +151,10 @@ def transition_model(corpus, page, damping_factor):
         for var in corpus.keys() 
     }
     
-    linked_prob = damping_factor / len(corpus[page])
-    for p in corpus[page]:
+    # A page with no links is treated as linking to every page
+    linked_pages = corpus[page] or corpus.keys()
+    linked_prob = damping_factor / len(linked_pages)
+    for p in linked_pages:
         prob_dist[p] = linked_prob
 
     for p in corpus.keys():
@@ -74,6 +163,30 @@ def transition_model(corpus, page, damping_factor):
     return prob_dist
 
 
+def _walk(indptr, indices, out_deg, d, start, n, out_counts):
+    """
+    Walk `n` steps from page `start` along the CSR link graph,
+    counting every page visited in `out_counts`.
+
+    With probability `d`, follow a link at random from the current
+    page. Otherwise, or if the page has no links, jump to a page at
+    random chosen from all pages in the corpus.
+    """
+    N = out_deg.shape[0]
+    p = start
+    for i in range(n):
+        k = out_deg[p]
+        if k > 0 and np.random.random() < d:
+            p = indices[indptr[p] + np.random.randint(0, k)]
+        else:
+            p = np.random.randint(0, N)
+        out_counts[p] += 1
+
+
+if njit is not None:
+    _walk = njit(cache=True)(_walk)
+
+
 def sample_pagerank(corpus, damping_factor, n):
     """
     Return PageRank values for each page by sampling `n` pages
@@ -83,25 +196,66 @@ def sample_pagerank(corpus, damping_factor, n):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    rank = 0
-    pagerank  = {
-        var: rank
-        for var in corpus.keys()
-    }
+    return _sample_csr(*corpus_csr(corpus), damping_factor, n)
 
-    rand = random.randint(0,len(corpus)-1)
-    page = list(corpus.keys())[rand] # Take the first page randomly
-    prob_dist = transition_model(corpus,page,damping_factor) # Initialize a transition model
-    pagerank[page] += 1
-    for sample in range(n):
-        page = random.choices(list(prob_dist.keys()), weights=[round(val*100, 6) for val in prob_dist.values()], k=1)[0]
-        prob_dist = transition_model(corpus,page,damping_factor)
-        pagerank[page] += 1
 
-    for p in pagerank:
-        pagerank[p] /= n
+def _sample_csr(pages, indptr, indices, out_deg, damping_factor, n):
+    """
+    Return `sample_pagerank` of the CSR link graph returned by
+    `crawl_csr` or `corpus_csr`.
+    """
+    N = len(pages)
 
-    return pagerank 
+    start = random.randrange(N) # Take the first page randomly
+    counts = np.zeros(N, dtype=np.int64)
+    counts[start] += 1
+    _walk(indptr, indices, out_deg, damping_factor, start, n - 1, counts)
+
+    return dict(zip(pages, (counts / n).tolist()))
+
+
+def transpose_csr(indptr, indices, out_deg):
+    """
+    Return the CSR link graph `(indptr, indices, out_deg)` transposed.
+
+    Return a tuple `(indptr, indices)` where the links into page `v`
+    come from the pages `indices[indptr[v]:indptr[v + 1]]`.
+    """
+    N = len(out_deg)
+    src = np.repeat(np.arange(N, dtype=np.int32), out_deg)
+
+    order = np.argsort(indices, kind="stable")
+    t_indptr = np.zeros(N + 1, dtype=np.int32)
+    t_indptr[1:] = np.cumsum(np.bincount(indices, minlength=N))
+
+    return t_indptr, src[order]
+
+
+def _pr_sweep(indptr, indices, order, pr, spr, inv_deg, d, N, dsum):
+    """
+    Update the ranks `pr` in place, visiting pages in `order`, and
+    return the sum of the absolute changes of all ranks, the L1 norm
+    compared against TOLERANCE.
+
+    `spr` holds the ranks divided by the number of links of each page
+    and is kept up to date, and `dsum` is the rank every page receives
+    from pages with no links.
+    """
+    delta = 0.0
+    # Later pages in the sweep already see the updated ranks
+    for v in order:
+        s = 0.0
+        for k in range(indptr[v], indptr[v + 1]):
+            s += spr[indices[k]]
+        new_rank = (1 - d) / N + dsum + d * s
+        delta += abs(new_rank - pr[v])
+        pr[v] = new_rank
+        spr[v] = new_rank * inv_deg[v]
+    return delta
+
+
+if njit is not None:
+    _pr_sweep = njit(cache=True, fastmath=True)(_pr_sweep)
 
 
 def iterate_pagerank(corpus, damping_factor):
@@ -113,39 +267,75 @@ def iterate_pagerank(corpus, damping_factor):
     their estimated PageRank value (a value between 0 and 1). All
     PageRank values should sum to 1.
     """
-    N = len(corpus)
-    initial_rank = 1 / N
-    pagerank = {page: initial_rank for page in corpus.keys()}
-    updated_pagerank = {page: 0 for page in corpus.keys()}
-
-    repeat = True
-    while repeat:
-        repeat = False
-        for page in pagerank.keys():
-            total_contribution = 0
-            for linking_page, linked_pages in corpus.items():
-                num_links = len(linked_pages)
-                if num_links == 0:
-                    num_links = N
-                if page in linked_pages:
-                    total_contribution += pagerank[linking_page] / num_links
-            
-            new_rank = (1 - damping_factor) / N + damping_factor * total_contribution
-            new_rank = round(new_rank, 4)  # Round after calculations
-            
-            # Stop iteration when the values changed no more than 0.001
-            if round(abs(new_rank - pagerank[page]),4) > 0.001:
-                repeat = True
-
-            updated_pagerank[page] = new_rank
-
-        # Normalize ranks to sum to 1
-        for page in updated_pagerank.keys():
-            updated_pagerank[page] = math.floor(updated_pagerank[page]*10000)/10000
-        
-        pagerank = updated_pagerank.copy()
-
-    return pagerank
+    return _iterate_csr(*corpus_csr(corpus), damping_factor)
+
+
+def _iterate_csr(pages, indptr, indices, out_deg, damping_factor):
+    """
+    Return `iterate_pagerank` of the CSR link graph returned by
+    `crawl_csr` or `corpus_csr`.
+    """
+    N = len(pages)
+    # A page with no links is treated as linking to every page, which
+    # spreads its rank evenly over the whole corpus
+    dangling = np.flatnonzero(out_deg == 0)
+    inv_deg = np.divide(
+        1.0, out_deg, out=np.zeros(N, dtype=np.float32), where=out_deg > 0
+    )
+    indptr, indices = transpose_csr(indptr, indices, out_deg)
+    # Visit the most linked to pages first so their ranks spread sooner
+    order = np.argsort(-np.diff(indptr), kind="stable")
+    # Single precision ranks halve the memory traffic per edge
+    pr = np.full(N, 1 / N, dtype=np.float32)
+    spr = pr * inv_deg
+    if njit is None:
+        new_pr = np.empty(N, dtype=np.float32)
+        if csr_matrix is not None:
+            # Transposed Markov matrix of the links between pages, in
+            # double precision so that long rows sum without drift
+            M_T = csr_matrix(
+                (inv_deg[indices].astype(np.float64), indices, indptr),
+                shape=(N, N)
+            )
+        else:
+            row_of_edge = np.repeat(np.arange(N), np.diff(indptr))
+
+    # Give up after MAX_ITERATIONS in case rounding keeps the ranks from
+    # settling within TOLERANCE
+    for _ in range(MAX_ITERATIONS):
+        dsum = damping_factor * pr[dangling].sum() / N
+        if njit is not None:
+            delta = _pr_sweep(
+                indptr, indices, order, pr, spr, inv_deg, damping_factor, N, dsum
+            )
+            # Updating in place does not keep the ranks summing to 1, so
+            # rescale them after every sweep
+            scale = 1 / pr.sum()
+            pr *= scale
+            spr *= scale
+        else:
+            if csr_matrix is not None:
+                new_pr[:] = M_T @ pr
+            else:
+                np.multiply(pr, inv_deg, out=spr)
+                new_pr[:] = np.bincount(
+                    row_of_edge, weights=spr[indices], minlength=N
+                )
+            new_pr *= damping_factor
+            new_pr += (1 - damping_factor) / N + dsum
+            delta = np.abs(new_pr - pr).sum()
+            pr, new_pr = new_pr, pr
+
+        # Stop iteration when the values changed no more than TOLERANCE
+        # in total (L1 norm of the change)
+        if delta <= TOLERANCE:
+            break
+
+    # Normalize ranks to sum to 1
+    pr = pr.astype(np.float64)
+    pr /= pr.sum()
+
+    return dict(zip(pages, pr.tolist()))
 
 
 if __name__ == "__main__":